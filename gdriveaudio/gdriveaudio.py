@@ -5,14 +5,18 @@ import re
 import json
 import csv
 import sys
+import random
+import hashlib
+import uuid
 import sqlite3
+import shutil
 import subprocess
 import warnings
 from argparse import ArgumentParser
 from collections import namedtuple
 #from logging import getLogger, basicConfig
-from tempfile import TemporaryDirectory
-from concurrent.futures import ThreadPoolExecutor
+from tempfile import TemporaryDirectory, mkdtemp
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import chardet
 from tqdm import tqdm
 from googleapiclient.discovery import build
@@ -29,6 +33,21 @@ class config:
     chardet_threshold: float = 0.95
     mplayer = "mplayer"
     ffprobe = "ffprobe"
+    ffmpeg = "ffmpeg"
+    cachedir: str = None
+    cache_codec: str = "opus"
+    cache_bitrate: str = "96k"
+
+# codec name --> (ffmpeg encoder, file extension) of the compact cache files
+_CACHE_CODECS = {
+    "opus":   ("libopus", "opus"),
+    "vorbis": ("libvorbis", "ogg"),
+    "mp3":    ("libmp3lame", "mp3"),
+    "aac":    ("aac", "m4a"),
+}
+# used to select files to transcode when the bitrate cannot be estimated
+_LOSSLESS_MIMETYPES = ("audio/flac", "audio/x-flac", "audio/wav", "audio/x-wav", "audio/wave",
+                       "audio/aiff", "audio/x-aiff", "audio/x-ape", "audio/x-wavpack")
 
 def _set_default_config():
     # 1. Use GDRIVEAUDIO_DIRECTORY env variable as the project root
@@ -38,6 +57,7 @@ def _set_default_config():
         # use this directory as the working directory for this tool
         config.credentialjson = os.path.join(workdir, "_credentials.json")
         config.dbfile         = os.path.join(workdir, "_gdriveaudio.db")
+        config.cachedir       = os.path.join(workdir, "_cache")
     config.encoding = "utf8"
     config.chardet_threshold = 0.95
 
@@ -49,6 +69,15 @@ def _set_config(**kwargs):
             print("'%' is not a valid config name; skipped")
             continue
         setattr(config, key, value)
+
+def _worker_config()-> dict:
+    # config values to pass to the worker processes
+    # note: worker processes may be spawned (not forked), where the config is reset to the default
+    keys = ("credentialjson", "dbfile", "ffmpeg", "cachedir", "cache_codec", "cache_bitrate")
+    return {key: getattr(config, key) for key in keys}
+
+def _init_worker(settings: dict):
+    _set_config(**settings)
 # ***   END OF CONFIGURATION   *************************************************** #
 
 
@@ -56,14 +85,30 @@ def _set_config(**kwargs):
 AudioFile = namedtuple("AudioFile", "id name mimetype parent size md5checksum")
 AudioMeta = namedtuple("AudioMeta", "id title artist album album_artist track date year genre duration")
 Folder    = namedtuple("Folder",    "id name parent fullpath")
+CompactFile = namedtuple("CompactFile", "md5checksum filename codec bitrate size")
+PlayState = namedtuple("PlayState", "queue session query seed total position")
 
 def _database_exists()-> bool:
     return os.path.isfile(config.dbfile)
 
-def _get_sql(query: str, header: bool=False):
-    with sqlite3.connect(config.dbfile) as conn:
+def _shuffle_key(seed: int, value)-> int:
+    # deterministic pseudo-random key of a value given the seed
+    # rows with the same value get the same key, which realizes the shuffle by groups
+    h = hashlib.md5(("%s:%s" % (seed, value)).encode("utf8")).digest()
+    return int.from_bytes(h[:7], "big")  # fits in sqlite integer
+
+def _connect():
+    conn = sqlite3.connect(config.dbfile)
+    conn.create_function("shuffle_key", 2, _shuffle_key)
+    return conn
+
+def _get_sql(query: str, header: bool=False, value=None):
+    with _connect() as conn:
         c = conn.cursor()
-        c.execute(query)
+        if value is not None:
+            c.execute(query, value)
+        else:
+            c.execute(query)
         if header:
             yield [a[0] for a in c.description] # column names
         for row in c:
@@ -71,7 +116,7 @@ def _get_sql(query: str, header: bool=False):
 
 def _exec_sql(query: str, value=None, values=None)-> int:
     assert value is None or values is None
-    with sqlite3.connect(config.dbfile) as conn:
+    with _connect() as conn:
         c = conn.cursor()
         if values is not None:
             c.executemany(query, values)
@@ -83,6 +128,20 @@ def _exec_sql(query: str, value=None, values=None)-> int:
         # return the number of rows affected
         return c.rowcount
 
+def _exec_sql_batches(query: str, values, batchsize: int=100)-> int:
+    # commits every batchsize rows so that the database is not write-locked for long
+    # and the committed rows are kept even if interrupted
+    n = 0
+    batch = []
+    for value in values:
+        batch.append(value)
+        if len(batch) >= batchsize:
+            n += _exec_sql(query, values=batch)
+            batch = []
+    if len(batch) > 0:
+        n += _exec_sql(query, values=batch)
+    return n
+
 def _validate_sql(query: str, value=None, values=None)-> tuple:
     try:
         _exec_sql(query, value=value, values=values)
@@ -231,6 +290,12 @@ def _generate_audiometa_data(ids: list, names: list):
         for meta in t.map(_task, ids, names):
             if meta is None: continue
             yield meta
+
+def _generate_compact_data(ids: list, names: list, md5checksums: list, workers: int=None):
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(_worker_config(),)) as p:
+        for compact in p.map(_transcode_task, ids, names, md5checksums):
+            if compact is None: continue
+            yield compact
 # ***   END OF GOOGLE DRIVE HELPERS   ************************************************ #
 
 
@@ -307,12 +372,139 @@ def _play_audiofile(filepath: str):
     command = [config.mplayer, "-vo", "null", filepath]
     p = subprocess.run(command)
 
+def _transcode_audiofile(md5checksum: str, filepath: str)-> CompactFile:
+    # transcode the file into the compact codec and save it in the cache directory
+    encoder, ext = _CACHE_CODECS[config.cache_codec]
+    os.makedirs(config.cachedir, exist_ok=True)
+    filename = "%s.%s" % (md5checksum, ext)
+    # write to a unique temporary directory first so that a broken file is never registered
+    # and concurrent processes on the same file do not collide
+    # the directory is on the same file system for the final move, and removed even if interrupted
+    with TemporaryDirectory(prefix=".tmp", dir=config.cachedir) as tmpdir:
+        tmpfile = os.path.join(tmpdir, filename)
+        command = [config.ffmpeg, "-v", "error", "-y", "-i", filepath, "-vn", "-map_metadata", "0",
+                   "-c:a", encoder, "-b:a", config.cache_bitrate, tmpfile]
+        p = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        if p.returncode != 0:
+            raise RuntimeError("'%s' failed with error:\n%s" % (" ".join(command), p.stderr.decode(errors="ignore")))
+        if os.path.getsize(tmpfile) >= os.path.getsize(filepath):
+            # no gain, registered without a file so that it is not transcoded again
+            return CompactFile(md5checksum=md5checksum, filename=None, codec=config.cache_codec,
+                               bitrate=config.cache_bitrate, size=None)
+        outfile = os.path.join(config.cachedir, filename)
+        os.replace(tmpfile, outfile)
+    return CompactFile(md5checksum=md5checksum, filename=filename, codec=config.cache_codec,
+                       bitrate=config.cache_bitrate, size=os.path.getsize(outfile))
+
+def _transcode_task(id: str, name: str, md5checksum: str, filepath: str=None)-> CompactFile:
+    # runs in a worker process
+    # if filepath is given, the file has already been fetched to its own directory,
+    # which is deleted after transcoding
+    # otherwise, the file is fetched to a temporary directory here
+    prefetched = filepath is not None
+    try:
+        if prefetched:
+            return _transcode_audiofile(md5checksum, filepath)
+        with TemporaryDirectory() as tmpdir:
+            filepath = _fetch_file(id, name, tmpdir)
+            return _transcode_audiofile(md5checksum, filepath)
+    except Exception as e:
+        warnings.warn("Failed to transcode file '%s' '%s' due to error '%s'" % (id, name, e))
+        return None
+    finally:
+        if prefetched:
+            shutil.rmtree(os.path.dirname(filepath), ignore_errors=True)
+
+def _find_compact_file(md5checksum: str)-> str:
+    # returns the path to the compact variant if available, None otherwise
+    # any codec and bitrate is accepted, outdated entries are replaced only by 'update -C'
+    if md5checksum is None:
+        return None
+    q = "SELECT filename FROM compactfiles WHERE md5checksum = ? AND filename IS NOT NULL"
+    for (filename,) in _get_sql(q, value=(md5checksum,)):
+        filepath = os.path.join(config.cachedir, filename)
+        if os.path.isfile(filepath):
+            return filepath
+    return None
+
+def _parse_bitrate(x: str)-> float:
+    # ffmpeg style bitrate, e.g. '96k' --> 96000.0
+    r = re.match(r"(\d+(?:\.\d+)?)([kKmM]?)$", x)
+    assert r is not None, ("Failed to interpret bitrate '%s'" % x)
+    unit = {"": 1, "k": 1e3, "m": 1e6}[r.group(2).lower()]
+    return float(r.group(1)) * unit
+
+def _compactable_condition()-> str:
+    # condition on the audio view to select the files worth transcoding
+    # the source bitrate is estimated from the size and duration, which must exceed the target
+    # if the duration is unknown (no metadata), only lossless files are selected
+    return """
+    md5checksum IS NOT NULL AND (
+      (duration > 0 AND size * 8.0 / duration > {bitrate})
+      OR (IFNULL(duration, 0) <= 0 AND mimetype IN ({mimetypes}))
+    )
+    """.format(bitrate=_parse_bitrate(config.cache_bitrate),
+               mimetypes=",".join("'%s'" % m for m in _LOSSLESS_MIMETYPES))
+
+def _load_cache_settings()-> tuple:
+    # returns (codec, bitrate) set by the last 'update -C', None if not available
+    for row in _get_sql("SELECT codec, bitrate FROM cachesettings"):
+        return tuple(row)
+    return None
+
+def _save_cache_settings(codec: str, bitrate: str):
+    _exec_sql("DELETE FROM cachesettings")
+    _exec_sql("INSERT INTO cachesettings VALUES (?,?)", value=(codec, bitrate))
+
+def _set_cache_config(codec: str=None, bitrate: str=None):
+    # use the given values first, then the ones stored by the last 'update -C', then the defaults
+    stored = _load_cache_settings()
+    if stored is not None:
+        codec = stored[0] if codec is None else codec
+        bitrate = stored[1] if bitrate is None else bitrate
+    if codec is not None:
+        _set_config(cache_codec=codec)
+    if bitrate is not None:
+        _set_config(cache_bitrate=bitrate)
+
+def _is_compactable(id: str)-> bool:
+    # used by 'play --cache', skips files with any entry including those without gain,
+    # since play does not replace entries made with other settings
+    q = """
+    SELECT COUNT(*) FROM audio
+    WHERE id = ? AND {} AND md5checksum NOT IN (SELECT md5checksum FROM compactfiles)
+    """.format(_compactable_condition())
+    for (n,) in _get_sql(q, value=(id,)):
+        return n > 0
+    return False
+
+def _remove_cache_file(filename: str):
+    if filename is None:
+        return
+    filepath = os.path.join(config.cachedir, filename)
+    if os.path.isfile(filepath):
+        os.unlink(filepath)
+
+def _save_compact_file(compact: CompactFile):
+    q = "SELECT filename FROM compactfiles WHERE md5checksum = ?"
+    old = [row[0] for row in _get_sql(q, value=(compact.md5checksum,))]
+    placeholder = ",".join("?" * len(CompactFile._fields))
+    q = "INSERT OR REPLACE INTO compactfiles VALUES ({})".format(placeholder)
+    _exec_sql(q, value=compact)
+    # remove the file of the replaced entry, e.g. one with the previous codec
+    for filename in old:
+        if filename != compact.filename:
+            _remove_cache_file(filename)
+
 def _check_mplayer():
     return _check_command([config.mplayer, "--help"])
 
 def _check_ffprobe():
     return _check_command([config.ffprobe, "-version"])
 
+def _check_ffmpeg():
+    return _check_command([config.ffmpeg, "-version"])
+
 def _check_command(command: list)-> bool:
     #print(command)
     try:
@@ -320,7 +512,7 @@ def _check_command(command: list)-> bool:
         #print(p)
     except Exception as e:
         raise ValueError("'%s' does not seem a valid command; '%s' failed with error:: %s" % (
-            config.ffprobe, " ".join(command), e))
+            command[0], " ".join(command), e))
     return True
 # ***   END OF PLAYER HELPERS   ******************************************************* #
 
@@ -368,6 +560,9 @@ def init_database():
     )
     """)
 
+    _create_compactfiles_table()
+    _create_playqueue_tables()
+
     _exec_sql("""
     CREATE VIEW IF NOT EXISTS audio AS
     SELECT
@@ -380,6 +575,52 @@ def init_database():
       LEFT JOIN folders   AS f ON a.parent = f.id
     """)
 
+def _create_compactfiles_table():
+    # mapping from md5checksum to the transcoded file in the cache directory
+    # called also on play and update so that databases created by older versions work
+    _exec_sql("""
+    CREATE TABLE IF NOT EXISTS compactfiles (
+         md5checksum  TEXT UNIQUE PRIMARY KEY
+        ,filename     TEXT
+        ,codec        TEXT
+        ,bitrate      TEXT
+        ,size         INTEGER
+    )
+    """)
+
+    # single row of the codec and bitrate used by the last 'update -C'
+    _exec_sql("""
+    CREATE TABLE IF NOT EXISTS cachesettings (
+         codec        TEXT
+        ,bitrate      TEXT
+    )
+    """)
+
+def _create_playqueue_tables():
+    # playqueue holds the audio ids in the play order of each named queue
+    # playstate holds the definition and the last played position of each queue,
+    # and the session currently playing it
+    # called also on play so that databases created by older versions work
+    _exec_sql("""
+    CREATE TABLE IF NOT EXISTS playqueue (
+         queue        TEXT
+        ,position     INTEGER
+        ,id           TEXT
+        ,PRIMARY KEY (queue, position)
+    )
+    """)
+
+    _exec_sql("""
+    CREATE TABLE IF NOT EXISTS playstate (
+         queue        TEXT UNIQUE PRIMARY KEY
+        ,session      TEXT
+        ,query        TEXT
+        ,seed         INTEGER
+        ,total        INTEGER
+        ,position     INTEGER
+    )
+    """)
+
 def _compile_keyword(keyword, case_sensitive=False):
     #q = """SELECT name FROM pragma_table_info('audio') WHERE type LIKE 'TEXT'"""
     #textcols = [row[0] for row in _get_sql(q)]
@@ -417,17 +658,18 @@ def _compile_filter(query: str=None, keywords :list=None, keywords_case_sensitiv
             filters.append(_compile_keyword(k, True))
     return " AND ".join("(%s)" % f for f in filters) if len(filters) > 0 else None
 
-def _tables_and_orderby(shuffle: list=None, sort: list=None)-> tuple:
+def _tables_and_orderby(shuffle: list=None, sort: list=None, seed: int=None)-> tuple:
     # returns (tables, orderby) queries
     # used by show_data and play functions
+    # shuffle is reproducible given the seed, which callers generate and show if not given
     audio_cols = set([row[0] for row in _get_sql("SELECT name FROM pragma_table_info('audio')", header=True)])
     tables = ["audio AS a"]
     orderby = []
     if shuffle is not None:
+        assert seed is not None, "Seed is required to shuffle"
         for c in shuffle:
             assert c in audio_cols, "'%s' is not a valid column name, must be one of %s" % (c, audio_cols)
-            tables.append("""INNER JOIN (SELECT "{c}", random() AS random_{c} FROM audio GROUP BY 1) USING({c})""".format(c=c))
-            orderby.append("random_{}".format(c))
+            orderby.append("""shuffle_key({seed}, a."{c}")""".format(seed=int(seed), c=c))
     if sort is not None:
         for c in sort:
             r = re.match(r"(\-{0,1})(.+)", c)
@@ -440,45 +682,176 @@ def _tables_and_orderby(shuffle: list=None, sort: list=None)-> tuple:
     tables = " ".join(tables)
     return tables, orderby
 
-def play_audio(filter: str=None, repeat: bool=False, shuffle: list=None, sort: list=None):
-    _check_mplayer()
-    if not _database_exists():
-        print("Database '%s' file not found. Run 'gdriveaudio update -U' first" % config.dbfile)
-        return
+def _random_seed()-> int:
+    return random.randrange(2**31)
+
+def _new_session()-> str:
+    return uuid.uuid4().hex
 
-    tables, orderby = _tables_and_orderby(shuffle=shuffle, sort=sort)
-    if orderby == "":
-        orderby = "ORDER BY random()"
-    columns = "id, name, prefix"
+def _build_playqueue(queue: str, session: str, filter: str=None,
+                     shuffle: list=None, sort: list=None, seed: int=None)-> PlayState:
+    # the sort runs inside sqlite and the result is stored in the playqueue table
+    # so that the whole library is never loaded into memory
+    tables, orderby = _tables_and_orderby(shuffle=shuffle, sort=sort, seed=seed)
+    # files are shuffled if no order is specified, and within the groups otherwise
+    tiebreak = "shuffle_key({}, a.id)".format(int(seed))
+    orderby = "{}, {}".format(orderby, tiebreak) if orderby != "" else "ORDER BY {}".format(tiebreak)
     where = "WHERE {}".format(filter) if filter is not None else ""
 
-    q = "SELECT {columns} FROM {tables} {where} {orderby}".format(
-        columns=columns, tables=tables, where=where, orderby=orderby)
+    q = "SELECT ?, ROW_NUMBER() OVER ({orderby}), a.id FROM {tables} {where}".format(
+        tables=tables, where=where, orderby=orderby)
     #print(q)
-    flag, e = _validate_sql(q)
+    # compile only, running the query here would sort the library twice
+    flag, e = _validate_sql("EXPLAIN " + q, value=(queue,))
     if not flag:
         raise ValueError("Query is invalid:\n'{}'\nError:\n'{}'".format(q, e))
 
+    # one transaction so that an interrupted build leaves the previous queue as is,
+    # and other sessions never see a partial queue
+    with _connect() as conn:
+        c = conn.cursor()
+        c.execute("DELETE FROM playqueue WHERE queue = ?", (queue,))
+        c.execute("INSERT INTO playqueue {}".format(q), (queue,))
+        state = PlayState(queue=queue, session=session, query=q, seed=seed, total=c.rowcount, position=0)
+        c.execute("INSERT OR REPLACE INTO playstate VALUES (?,?,?,?,?,?)", state)
+    return state
+
+def _load_playstate(queue: str)-> PlayState:
+    for row in _get_sql("SELECT * FROM playstate WHERE queue = ?", value=(queue,)):
+        return PlayState(*row)
+    return None
+
+def _take_over_playstate(state: PlayState, session: str)-> PlayState:
+    _exec_sql("UPDATE playstate SET session = ? WHERE queue = ?", value=(session, state.queue))
+    return state._replace(session=session)
+
+def _save_playposition(state: PlayState, position: int)-> bool:
+    # returns False if the queue has been rebuilt or resumed by another session
+    # the database may be locked by an update running at the same time,
+    # losing the position is not worth stopping the play
+    try:
+        q = "UPDATE playstate SET position = ? WHERE queue = ? AND session = ?"
+        return _exec_sql(q, value=(position, state.queue, state.session)) > 0
+    except sqlite3.OperationalError as e:
+        warnings.warn("Failed to save the play position due to the error:\n%s" % e)
+        return True
+
+def _iter_playqueue(queue: str, start: int=0, chunksize: int=100):
+    # yields (position, id, name, prefix, md5checksum) after the start position
+    # reads by small chunks so that the database is not locked while playing
+    q = """
+    SELECT q.position, a.id, a.name, a.prefix, a.md5checksum
+    FROM playqueue AS q INNER JOIN audio AS a ON q.id = a.id
+    WHERE q.queue = ? AND q.position > ? ORDER BY q.position LIMIT ?
+    """
     while True:
-        files = list(_get_sql(q))
-        print("Found %d files" % len(files))
-        for i, (id, name, prefix) in enumerate(files):
-            with TemporaryDirectory() as tmpdir:
+        rows = list(_get_sql(q, value=(queue, start, chunksize)))
+        if len(rows) == 0:
+            break
+        for row in rows:
+            yield row
+        start = rows[-1][0]
+
+def _save_transcoded(future):
+    # callback of background transcoding, runs in the parent process
+    try:
+        compact = future.result()
+        if compact is not None:
+            _save_compact_file(compact)
+    except Exception as e:
+        warnings.warn("Failed to save the transcoded file due to the error:\n%s" % e)
+
+def play_audio(filter: str=None, repeat: bool=False, shuffle: list=None, sort: list=None, cache: bool=False,
+               seed: int=None, resume: bool=False, queue: str="default",
+               cache_codec: str=None, cache_bitrate: str=None, cache_workers: int=1):
+    _check_mplayer()
+    if cache:
+        _check_ffmpeg()
+    if not _database_exists():
+        print("Database '%s' file not found. Run 'gdriveaudio update -U' first" % config.dbfile)
+        return
+    _create_compactfiles_table()
+    _create_playqueue_tables()
+    _set_cache_config(codec=cache_codec, bitrate=cache_bitrate)
+
+    session = _new_session()
+    state = None
+    if resume:
+        state = _load_playstate(queue)
+        if state is None or state.position >= state.total:
+            print("No play queue '%s' to resume, starting a new one" % queue)
+            state = None
+        else:
+            state = _take_over_playstate(state, session)
+            print("Resuming the play queue '%s' from %d/%d (seed %d)" % (
+                queue, state.position+1, state.total, state.seed))
+    if state is None:
+        if seed is None:
+            seed = _random_seed()
+        state = _build_playqueue(queue, session, filter=filter, shuffle=shuffle, sort=sort, seed=seed)
+        print("Found %d files (seed %d)" % (state.total, state.seed))
+        if state.total == 0:
+            return
+
+    # with cache option, fetched files are transcoded into the cache directory in the background
+    # a small number of workers so as not to compete with the player
+    pool = ProcessPoolExecutor(max_workers=cache_workers, initializer=_init_worker,
+                               initargs=(_worker_config(),)) if cache else None
+    queued = set()  # md5checksums already sent to the pool
+    start = state.position
+    try:
+        while True:
+            played = 0
+            for position, id, name, prefix, md5checksum in _iter_playqueue(queue, start):
+                played += 1
                 try:
-                    service = _create_api_service()
-                    request = service.files().get_media(fileId=id)
-                    filepath = _fetch_file(id, name, tmpdir)
+                    compactpath = _find_compact_file(md5checksum)
+                    transcode = (pool is not None and compactpath is None
+                                 and md5checksum is not None and md5checksum not in queued
+                                 and _is_compactable(id))
+                except sqlite3.OperationalError as e:
+                    # the database may be locked by an update running at the same time
+                    # play the original file without caching
+                    warnings.warn("Failed to look up the compact file of '%s' (%s) due to the error:\n%s" % (name, id, e))
+                    compactpath, transcode = None, False
+                tmpdir = mkdtemp()
+                try:
+                    if compactpath is not None:
+                        filepath = compactpath
+                    else:
+                        filepath = _fetch_file(id, name, tmpdir)
                     print("***********************************************************")
-                    print("Playing %d/%d: %s (at %s)" % (i+1, len(files), name, prefix))
+                    print("Playing %d/%d: %s (at %s)" % (position, state.total, name, prefix))
                     _play_audiofile(filepath)
+                    if transcode:
+                        future = pool.submit(_transcode_task, id, name, md5checksum, filepath)
+                        future.add_done_callback(_save_transcoded)
+                        queued.add(md5checksum)
+                        tmpdir = None  # the worker deletes the directory after transcoding
                 except Exception as e:
                     warnings.warn("Failed to play '%s' (%s) due to the error:\n%s" % (name, id, e))
-        if not repeat:
-            print("Finished playing all files")
-            break
+                finally:
+                    if tmpdir is not None:
+                        shutil.rmtree(tmpdir, ignore_errors=True)
+                if not _save_playposition(state, position):
+                    print("The play queue '%s' has been taken by another session, stopping" % queue)
+                    return
+            if played == 0:
+                # e.g. the files in a resumed queue have been removed from the database
+                print("No files to play in the queue '%s'" % queue)
+                break
+            # repeat plays the same queue again from the beginning
+            start = 0
+            if not repeat:
+                print("Finished playing all files")
+                break
+    finally:
+        if pool is not None:
+            print("Waiting for the background transcoding to finish")
+            pool.shutdown(wait=True)
 
 def show_data(n: int=None, columns: list=None, filter: str=None, 
-              shuffle: list=None, sort: list=None,
+              shuffle: list=None, sort: list=None, seed: int=None,
               format: str="csv", json_ascii: bool=False, json_indent: int=None):
     if not _database_exists():
         print("Database '%s' file not found. Run 'gdriveaudio update -U' first" % config.dbfile)
@@ -492,7 +865,11 @@ def show_data(n: int=None, columns: list=None, filter: str=None,
             assert c in audio_cols, "'%s' is not a valid column name, must be one of %s" % (c, audio_cols)
         columns = ",".join('a."%s"' % c for c in columns)
 
-    tables, orderby = _tables_and_orderby(shuffle=shuffle, sort=sort)
+    if shuffle is not None and seed is None:
+        seed = _random_seed()
+        # stdout is used for the data
+        print("Shuffled with seed %d" % seed, file=sys.stderr)
+    tables, orderby = _tables_and_orderby(shuffle=shuffle, sort=sort, seed=seed)
     where = "WHERE {}".format(filter) if filter is not None else ""
     limit = "LIMIT {}".format(n) if n is not None else ""
 
@@ -514,7 +891,8 @@ def show_data(n: int=None, columns: list=None, filter: str=None,
         obj = [dict(zip(header, row)) for row in rows]
         json.dump(obj, sys.stdout, ensure_ascii=json_ascii, indent=json_indent)
 
-def update_audio_data(files: bool=False, meta: bool=False, replace_meta: bool=False, folders: bool=False):
+def update_audio_data(files: bool=False, meta: bool=False, replace_meta: bool=False, folders: bool=False,
+                      cache: bool=False, cache_codec: str=None, cache_bitrate: str=None, cache_workers: int=None):
     if not _database_exists():
         print("Initializing database")
         init_database()
@@ -527,6 +905,9 @@ def update_audio_data(files: bool=False, meta: bool=False, replace_meta: bool=Fa
     if meta:
         print("Updating audio meta data")
         _update_audiometa(replace=replace_meta)
+    if cache:
+        print("Updating compact audio cache")
+        _update_compactfiles(codec=cache_codec, bitrate=cache_bitrate, workers=cache_workers)
 
 def _update_audiofiles():
     _exec_sql("DELETE FROM audiofiles")
@@ -553,7 +934,7 @@ def _update_audiometa(replace: bool = False):
     total = len(ids)
     placeholder = ",".join("?" * len(AudioMeta._fields))
     q = "INSERT OR REPLACE INTO audiometa VALUES ({})".format(placeholder)
-    _exec_sql(q, values=tqdm(_generate_audiometa_data(ids, names), total=total))
+    _exec_sql_batches(q, tqdm(_generate_audiometa_data(ids, names), total=total))
 
 def _update_audiometa_one(id: str, filepath: str):
     meta = _get_audiometa(filepath)
@@ -563,6 +944,48 @@ def _update_audiometa_one(id: str, filepath: str):
     q = "INSERT OR REPLACE INTO audiometa VALUES ({})".format(placeholder)
     _exec_sql(q, value=meta)
 
+def _update_compactfiles(codec: str=None, bitrate: str=None, workers: int=None):
+    _check_ffmpeg()
+    _create_compactfiles_table()
+    _set_cache_config(codec=codec, bitrate=bitrate)
+    # play uses these settings afterwards
+    _save_cache_settings(config.cache_codec, config.cache_bitrate)
+    print("Compact audio codec: %s, bitrate: %s" % (config.cache_codec, config.cache_bitrate))
+    # delete entries whose cache files are missing
+    q = "SELECT md5checksum, filename FROM compactfiles"
+    missing = [(row[0],) for row in _get_sql(q)
+               if row[1] is not None and not os.path.isfile(os.path.join(config.cachedir, row[1]))]
+    if len(missing) > 0:
+        _exec_sql("DELETE FROM compactfiles WHERE md5checksum = ?", values=missing)
+        print("Cache entries for missing files are deleted (%d affected)" % len(missing))
+
+    # delete entries with different codec or bitrate so that they are transcoded again
+    settings = (config.cache_codec, config.cache_bitrate)
+    q = "SELECT md5checksum, filename FROM compactfiles WHERE codec != ? OR bitrate != ?"
+    outdated = list(_get_sql(q, value=settings))
+    if len(outdated) > 0:
+        for _, filename in outdated:
+            _remove_cache_file(filename)
+        _exec_sql("DELETE FROM compactfiles WHERE md5checksum = ?", values=[(row[0],) for row in outdated])
+        print("Cache entries with different codec or bitrate are deleted (%d affected)" % len(outdated))
+
+    # files with the same content are transcoded once
+    q = """
+    SELECT id, name, md5checksum FROM audio
+    WHERE {} AND md5checksum NOT IN (SELECT md5checksum FROM compactfiles WHERE codec = ? AND bitrate = ?)
+    GROUP BY md5checksum
+    """.format(_compactable_condition())
+    files = [(row[0], row[1], row[2]) for row in _get_sql(q, value=settings)]
+    if len(files)==0:
+        print("No audio files found to transcode")
+        return
+    ids, names, md5checksums = zip(*files)
+    total = len(ids)
+    # each result is committed as it arrives, so that the database is not locked during the run
+    # and the finished files are kept registered even if interrupted
+    for compact in tqdm(_generate_compact_data(ids, names, md5checksums, workers=workers), total=total):
+        _save_compact_file(compact)
+
 def _update_folders():
     _exec_sql("DELETE FROM folders")
     placeholder = ",".join("?" * len(Folder._fields))
@@ -582,14 +1005,26 @@ def main():
                                help="Override the path to the google cloud credential JSON file with google drive permission")
     parent_parser.add_argument("-d", "--database-file", type=str, default=None,
                                help="Override the path to the sqlite database file")
+    parent_parser.add_argument("--cache-dir", type=str, default=None,
+                               help="Override the path to the directory of compact audio files")
+
+    cache = ArgumentParser(add_help=False)
+    cache.add_argument("--cache-codec", type=str, default=None, choices=tuple(_CACHE_CODECS),
+                       help="Codec of the compact audio files (default: last used by 'update -C', or opus)")
+    cache.add_argument("--cache-bitrate", type=str, default=None,
+                       help="Bitrate of the compact audio files (default: last used by 'update -C', or 96k)")
+    cache.add_argument("--ffmpeg", type=str, default="ffmpeg", help="ffmpeg command name")
+    cache.add_argument("--cache-workers", type=int, default=None,
+                       help="Number of processes for transcoding (default: number of CPUs for update, 1 for play)")
 
     init = subparsers.add_parser("init", parents=[parent_parser],
                                  help="Initialize database (all existing data will be deleted)")
 
-    update = subparsers.add_parser("update", help="Update data", parents=[parent_parser])
+    update = subparsers.add_parser("update", help="Update data", parents=[cache, parent_parser])
     update.add_argument("-U", "--update-filelist", action="store_true", help="Update file list")
     update.add_argument("-M", "--update-meta", action="store_true", help="Update audio metadata")
     update.add_argument("-F", "--update-folders", action="store_true", help="Update folder structure data")
+    update.add_argument("-C", "--update-cache", action="store_true", help="Transcode audio files into the compact cache")
     update.add_argument("--replace-meta", action="store_true", help="Replace existing metadata")
     update.add_argument("--metadata-encoding", type=str, default="utf8", help="Default encoding for audio metadata")
     update.add_argument("--chardet-threshold", type=float, default=0.95, help="Threshold to trust the chardet result")
@@ -603,9 +1038,15 @@ def main():
     search.add_argument("-q", "--filter-query", type=str, default=None, help="SQL query to select files to show")
     search.add_argument("-S", "--shuffle", type=str, nargs="+", help="Shuffle by the specified column(s)")
     search.add_argument("-s", "--sort", type=str, nargs="+", help="Sort by the specified column(s)")
+    search.add_argument("--seed", type=int, default=None, help="Random seed for the shuffle")
 
-    play = subparsers.add_parser("play", help="Play audio", parents=[search, parent_parser])
+    play = subparsers.add_parser("play", help="Play audio", parents=[search, cache, parent_parser])
     play.add_argument("--repeat", action="store_true", help="Repeat forever")
+    play.add_argument("--resume", action="store_true",
+                      help="Resume the last play queue from where it stopped (search options are ignored)")
+    play.add_argument("--queue", type=str, default="default",
+                      help="Name of the play queue, use different names to play in parallel")
+    play.add_argument("--cache", action="store_true", help="Transcode played files into the compact cache in background")
     play.add_argument("--mplayer", type=str, default="mplayer", help="mplayer command name")
 
     data = subparsers.add_parser("data", help="Show data in csv format", parents=[search, parent_parser])
@@ -626,27 +1067,37 @@ def main():
     # 1. If '--credential-json' or '--database-file' is given, use these values
     # 2. If '--workdir' is given, then use '{workdir}/_credentials.json' and '{workdir}/_gdriveaudio.db'
     # 3. Use '_credentials.json' and '_gdriveaudio.db' in the currenct directory
+    # Same rule applies to the cache directory ('--cache-dir', '{workdir}/_cache')
     if args.workdir is not None:
         _set_config(credentialjson=os.path.join(args.workdir, "_credentials.json"),
-                    dbfile=os.path.join(args.workdir, "_gdriveaudio.db"))
+                    dbfile=os.path.join(args.workdir, "_gdriveaudio.db"),
+                    cachedir=os.path.join(args.workdir, "_cache"))
     if args.credential_json is not None:
         _set_config(credentialjson=args.credential_json)
     if args.database_file is not None:
         _set_config(dbfile=args.database_file)
+    if args.cache_dir is not None:
+        _set_config(cachedir=args.cache_dir)
 
     if args.command == "init":
         init_database()
     elif args.command == "update":
-        _set_config(encoding=args.metadata_encoding, chardet_threshold=args.chardet_threshold, ffprobe=args.ffprobe)
+        _set_config(encoding=args.metadata_encoding, chardet_threshold=args.chardet_threshold, ffprobe=args.ffprobe,
+                    ffmpeg=args.ffmpeg)
         update_audio_data(files=args.update_filelist, meta=args.update_meta,
-                          replace_meta=args.replace_meta, folders=args.update_folders)
+                          replace_meta=args.replace_meta, folders=args.update_folders,
+                          cache=args.update_cache, cache_codec=args.cache_codec, cache_bitrate=args.cache_bitrate,
+                          cache_workers=args.cache_workers)
     elif args.command == "play":
-        _set_config(mplayer=args.mplayer)
+        _set_config(mplayer=args.mplayer, ffmpeg=args.ffmpeg)
         filter = _compile_filter(query=args.filter_query, keywords=args.keyword, keywords_case_sensitive=args.keyword_case_sensitive)
-        play_audio(filter=filter, repeat=args.repeat, shuffle=args.shuffle, sort=args.sort)
+        play_audio(filter=filter, repeat=args.repeat, shuffle=args.shuffle, sort=args.sort, cache=args.cache,
+                   seed=args.seed, resume=args.resume, queue=args.queue,
+                   cache_codec=args.cache_codec, cache_bitrate=args.cache_bitrate,
+                   cache_workers=args.cache_workers if args.cache_workers is not None else 1)
     elif args.command == "data":
         filter = _compile_filter(query=args.filter_query, keywords=args.keyword, keywords_case_sensitive=args.keyword_case_sensitive)
-        show_data(n=args.n, columns=args.columns, filter=filter,  shuffle=args.shuffle, sort=args.sort,
+        show_data(n=args.n, columns=args.columns, filter=filter,  shuffle=args.shuffle, sort=args.sort, seed=args.seed,
                   format=args.format, json_ascii=args.json_ascii, json_indent=args.json_indent)
 # ***   END OF MAIN PROCEDURE   ******************************************************* #
 